@@ -0,0 +1,201 @@
+"""toil_hla utils tests."""
+
+from argparse import Namespace
+from os.path import join
+import os
+import threading
+import time
+
+import pytest
+
+from toil_hla import exceptions
+from toil_hla import utils
+
+
+def get_queue_options(tmp_path, **kwargs):
+    samples = join(str(tmp_path), "samples.tsv")
+
+    with open(samples, "w", encoding="utf-8") as f:
+        f.write("sample_id\tbamfile\ttype\n")
+        f.write("s1\ts1.bam\tDNA\n\n")
+        f.write("s2\ts2.bam\tRNA\n")
+
+    options = Namespace(
+        outdir=str(tmp_path),
+        samples=samples,
+        normal_dna_id=None,
+        normal_dna=None,
+        tumor_dna_id=None,
+        tumor_dna=None,
+        tumor_rna_id=None,
+        tumor_rna=None,
+    )
+
+    vars(options).update(kwargs)
+    utils.reset_samples_queue(options)
+    return options
+
+
+def test_claim_next_sample(tmp_path):
+    options = get_queue_options(
+        tmp_path, tumor_dna_id="t1", tumor_dna=join(str(tmp_path), "t1.bam")
+    )
+
+    assert utils.claim_next_sample(options, 0, "a", 0).sample_id == "t1"
+    assert utils.claim_next_sample(options, 1, "b", 0).sample_id == "s1"
+    assert utils.claim_next_sample(options, 0, "a", 1).sample_id == "s2"
+    assert utils.claim_next_sample(options, 1, "b", 1) is None
+    assert utils.claim_next_sample(options, 1, "c", 0) is None
+
+
+def test_claim_next_sample_replays_retried_job(tmp_path):
+    options = get_queue_options(tmp_path)
+    first = utils.claim_next_sample(options, 0, "a", 0)
+
+    assert first == utils.Sample("s1", join(str(tmp_path), "s1.bam"), "DNA")
+    assert utils.claim_next_sample(options, 1, "b", 0).sample_id == "s2"
+
+    # a retried job claims its samples again, in the same order
+    assert utils.claim_next_sample(options, 0, "a", 0) == first
+    assert utils.claim_next_sample(options, 0, "a", 1) is None
+    assert utils.claim_next_sample(options, 0, "a", 1) is None
+
+
+def test_claim_next_sample_resumes_from_offset(tmp_path):
+    options = get_queue_options(tmp_path)
+
+    assert utils.claim_next_sample(options, 0, "a", 0).sample_id == "s1"
+
+    # rows before the saved offset are overwritten but never read again
+    with open(options.samples, "r+", encoding="utf-8") as f:
+        f.write("xx\txx.bam\tDNA\n")
+
+    with open(options.samples, "a", encoding="utf-8") as f:
+        f.write("s3\ts3.bam\tDNA\n")
+
+    assert utils.claim_next_sample(options, 0, "b", 0).sample_id == "s2"
+    assert utils.claim_next_sample(options, 0, "c", 0).sample_id == "s3"
+    assert utils.claim_next_sample(options, 0, "d", 0) is None
+
+
+def test_mark_sample(tmp_path):
+    options = get_queue_options(tmp_path)
+    dna = utils.Sample("s1", "s1.bam", "DNA")
+    rna = utils.Sample("s1", "s1.bam", "RNA")
+
+    assert utils.mark_sample(options, dna, "a")
+    assert utils.mark_sample(options, dna, "a")
+    assert not utils.mark_sample(options, dna, "b")
+    assert utils.mark_sample(options, rna, "b")
+    assert not utils.mark_sample(options, rna, "c")
+
+
+def get_slot_options(tmp_path):
+    return Namespace(lock_dir=str(tmp_path), slot_lease=60, slot_grant_timeout=240)
+
+
+def get_slot(token, max_jobs=2):
+    return utils.Slot(tool="lilac", max_jobs=max_jobs, token=token)
+
+
+def test_acquire_slot_caps_jobs(tmp_path):
+    options = get_slot_options(tmp_path)
+    first = utils.acquire_slot(options, get_slot("a"), "owner")
+
+    assert first == join(str(tmp_path), "lilac.0.slot")
+    assert utils.acquire_slot(options, get_slot("a")) == first
+    assert utils.acquire_slot(options, get_slot("b")) != first
+    assert utils.acquire_slot(options, get_slot("c")) is None
+    assert utils.get_slot_token(first) == "a"
+
+
+def test_acquire_slot_is_granted_until_job_starts(tmp_path):
+    options = get_slot_options(tmp_path)
+    path = utils.acquire_slot(options, get_slot("a"))
+
+    assert os.path.getmtime(path) > time.time() + 239 * 60
+    assert not utils.is_stale_slot(path, options.slot_lease * 60)
+
+
+def test_release_slot_only_removes_own_slot(tmp_path):
+    options = get_slot_options(tmp_path)
+    first = utils.acquire_slot(options, get_slot("a"))
+    second = utils.acquire_slot(options, get_slot("b"))
+    utils.release_slot(options, get_slot("a"))
+
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert utils.acquire_slot(options, get_slot("c")) == first
+
+
+def test_reclaim_stale_slot(tmp_path):
+    options = get_slot_options(tmp_path)
+    path = utils.acquire_slot(options, get_slot("a"))
+
+    assert not utils.reclaim_stale_slot(str(tmp_path), "lilac", path, 60)
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert utils.reclaim_stale_slot(str(tmp_path), "lilac", path, 60)
+    assert not os.path.exists(path)
+    assert not utils.reclaim_stale_slot(str(tmp_path), "lilac", path, 60)
+
+
+def test_acquire_slot_reclaims_stale_slot(tmp_path):
+    options = get_slot_options(tmp_path)
+    path = utils.acquire_slot(options, get_slot("a", max_jobs=1))
+    os.utime(path, (time.time() - 3601, time.time() - 3601))
+
+    assert utils.acquire_slot(options, get_slot("b", max_jobs=1)) == path
+    assert utils.get_slot_token(path) == "b"
+
+
+def test_reclaim_stale_slot_race(tmp_path):
+    options = get_slot_options(tmp_path)
+    path = utils.acquire_slot(options, get_slot("a", max_jobs=1))
+    os.utime(path, (time.time() - 3601, time.time() - 3601))
+    reclaimed = []
+
+    def reclaim():
+        reclaimed.append(utils.reclaim_stale_slot(str(tmp_path), "lilac", path, 60))
+
+    # a competing worker sees the stale slot while another worker replaces it
+    with utils.lock_slots(str(tmp_path), "lilac"):
+        competitor = threading.Thread(target=reclaim)
+        competitor.start()
+        competitor.join(0.5)
+        assert competitor.is_alive()
+
+        os.remove(path)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("b\n")
+
+    competitor.join()
+    assert reclaimed == [False]
+    assert utils.get_slot_token(path) == "b"
+
+
+def test_hold_slot(tmp_path):
+    options = get_slot_options(tmp_path)
+    path = utils.acquire_slot(options, get_slot("a"))
+
+    with utils.hold_slot(options, get_slot("a")) as held:
+        assert held == path
+        assert os.path.getmtime(path) <= time.time()
+
+    assert not os.path.exists(path)
+
+    with pytest.raises(ValueError):
+        with utils.hold_slot(options, get_slot("a")):
+            raise ValueError()
+
+    assert not [i for i in os.listdir(str(tmp_path)) if i.endswith(".slot")]
+
+
+def test_hold_slot_raises_without_slot(tmp_path):
+    options = get_slot_options(tmp_path)
+    utils.acquire_slot(options, get_slot("a", max_jobs=1))
+
+    with pytest.raises(exceptions.SlotUnavailableError):
+        with utils.hold_slot(options, get_slot("b", max_jobs=1)):
+            pass
+
+    assert utils.get_slot_token(join(str(tmp_path), "lilac.0.slot")) == "a"
@@ -23,3 +23,27 @@ HLA_GENES = [
     "TAP1",
     "TAP2",
 ]
+
+# MHC region in GRCh37 coordinates, used to estimate depth before downsampling
+MHC_REGION = "6:28477797-33448354"
+
+# tools whose concurrency can be capped with --max-{tool}-jobs
+THROTTLED_TOOLS = ["lilac", "hlascan", "arcashla"]
+
+# maximum seconds between polls for a free concurrency slot
+THROTTLE_MAX_WAIT = 300
+
+# expected runtime of each step as (minutes, minutes per GB of input BAM),
+# calibrate with the per step timings written to OUTDIR/makespan
+EXPECTED_RUNTIMES = {
+    "downsample": (10, 0.2),
+    "lilac": (20, 0.1),
+    "hlascan": (5, 0.05),
+    "arcashla_extract": (10, 0.5),
+    "arcashla_genotype": (15, 0.1),
+    "seq2hla": (20, 0.3),
+}
+
+# runtime hints passed to the batch system are the estimate times this margin,
+# custom_lsf resubmits jobs killed by their run limit with a larger limit
+RUNTIME_HINT_MARGIN = 2
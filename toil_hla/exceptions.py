@@ -9,3 +9,13 @@ class PackageBaseException(Exception):
 class ValidationError(PackageBaseException):
 
     """A class to raise when a validation error occurs."""
+
+
+class ThrottleTimeoutError(PackageBaseException):
+
+    """A class to raise when a concurrency slot can't be acquired in time."""
+
+
+class SlotUnavailableError(PackageBaseException):
+
+    """A class to raise when a capped job starts without a concurrency slot."""
@@ -3,11 +3,20 @@ from os.path import abspath
 from os.path import dirname
 from os.path import join
 from os.path import isdir
+import itertools
 import os
+import shutil
 import subprocess
+import time
+import uuid
 
 from toil_container import ContainerJob
 
+from toil_hla import constants
+from toil_hla import exceptions
+from toil_hla import utils
+from toil_hla import validators
+
 # data directory with required executables
 DATADIR = abspath(join(dirname(__file__), "data"))
 
@@ -24,6 +33,476 @@ class StartJob(ContainerJob):
         )
 
 
+class SampleChainJob(ContainerJob):
+    def __init__(self, options, chain, **kwargs):
+        """
+        Claim the next sample of the queue and type it.
+
+        `--max-samples-in-flight` chains run independently, each chain adds
+        itself as a follow-on once its sample is done. Thus a slow or failed
+        sample only holds its own chain while the others keep draining the
+        queue. Invalid samples are reported and skipped.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+            chain (int): chain index.
+        """
+        self.chain = chain
+        self.token = uuid.uuid4().hex
+
+        super().__init__(
+            memory=kwargs.pop("memory", "1G"),
+            options=options,
+            cores=kwargs.pop("cores", 1),
+            runtime=kwargs.pop("runtime", 90),
+            **kwargs,
+        )
+
+    def run(self, fileStore):
+        """Run the job."""
+        for attempt in itertools.count():
+            sample = utils.claim_next_sample(
+                self.options, self.chain, self.token, attempt
+            )
+
+            if sample is None:
+                return
+
+            try:
+                validators.validate_sample(sample)
+                if not utils.mark_sample(self.options, sample, self.token):
+                    msg = f"{sample.sample_id} {sample.kind} is duplicated."
+                    raise exceptions.ValidationError(msg)
+            except exceptions.ValidationError as error:
+                fileStore.logToMaster(f"Skipping invalid sample: {error}")
+                with open(
+                    utils.get_invalid_samples_file(self.options), "a", encoding="utf-8"
+                ) as f:
+                    f.write(f"{sample.sample_id}\t{sample.bamfile}\t{error}\n")
+                continue
+
+            self.addChild(SampleJob(options=self.options, sample=sample))
+            self.addFollowOn(SampleChainJob(options=self.options, chain=self.chain))
+            return
+
+
+class SamplesReportJob(ContainerJob):
+    def __init__(self, options, **kwargs):
+        """
+        Fail the pipeline if invalid samples were skipped.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+        """
+        super().__init__(
+            memory=kwargs.pop("memory", "1G"),
+            options=options,
+            cores=kwargs.pop("cores", 1),
+            runtime=kwargs.pop("runtime", 90),
+            **kwargs,
+        )
+
+    def run(self, fileStore):
+        """Run the job."""
+        invalid_samples = utils.get_invalid_samples_file(self.options)
+
+        if os.path.isfile(invalid_samples):
+            msg = f"Invalid samples were skipped, see: {invalid_samples}"
+            raise exceptions.ValidationError(msg)
+
+
+def add_typing_jobs(parent, options, sample, bamfile):
+    """
+    Add the typing jobs of a sample as children of `parent`.
+
+    Each job gets a runtime estimate scaled by the size of `bamfile`, which
+    is passed to the batch system as a hint, see `utils.get_runtime_hint`.
+
+    Arguments:
+        parent (object): parent job.
+        options (object): toil_hla options structure.
+        sample (utils.Sample): sample to be typed.
+        bamfile (str): path to the BAM file to be typed.
+    """
+    size_gb = utils.get_size_gb(bamfile)
+    kwargs = {"bamfile": bamfile, "sample_id": sample.sample_id}
+
+    def estimate(step):
+        return utils.estimate_runtime(step, size_gb)
+
+    if sample.kind == "DNA":
+        if options.lilac_img:
+            add_capped_child(
+                parent,
+                options,
+                "lilac",
+                LilacJob,
+                estimate=estimate("lilac"),
+                **kwargs,
+            )
+
+        if options.hlascan_tool:
+            for gene in constants.HLA_GENES:
+                add_capped_child(
+                    parent,
+                    options,
+                    "hlascan",
+                    HLAscanJob,
+                    gene=gene,
+                    estimate=estimate("hlascan"),
+                    **kwargs,
+                )
+
+    elif sample.kind == "RNA" and options.arcashla_img:
+        arcashla_extract = add_capped_child(
+            parent,
+            options,
+            "arcashla",
+            ArcasHLAExtract,
+            estimate=estimate("arcashla_extract"),
+            **kwargs,
+        )
+        add_capped_child(
+            arcashla_extract,
+            options,
+            "arcashla",
+            ArcasHLAGenotype,
+            estimate=estimate("arcashla_genotype"),
+            **kwargs,
+        )
+
+        if options.seq2hla_img:
+            arcashla_extract.addChild(
+                Seq2HLAJob(options=options, estimate=estimate("seq2hla"), **kwargs)
+            )
+
+
+def add_capped_child(parent, options, tool, job_class, **kwargs):
+    """
+    Add a `job_class` child to `parent`, honoring `--max-{tool}-jobs`.
+
+    When the cap is set a low resource `ThrottleJob` is added before the
+    job to acquire a concurrency slot, so capped jobs don't hold their
+    resources while waiting.
+
+    Arguments:
+        parent (object): parent job.
+        options (object): toil_hla options structure.
+        tool (str): tool name, one of `constants.THROTTLED_TOOLS`.
+        job_class (class): job class to instantiate.
+        kwargs (dict): extra `job_class` key word arguments.
+
+    Returns:
+        object: the `job_class` instance.
+    """
+    max_jobs = getattr(options, f"max_{tool}_jobs")
+
+    if not max_jobs:
+        job = job_class(options=options, **kwargs)
+        parent.addChild(job)
+        return job
+
+    slot = utils.Slot(tool=tool, max_jobs=max_jobs, token=uuid.uuid4().hex)
+    owner = " ".join([job_class.__name__] + [str(i) for i in kwargs.values()])
+    throttle = ThrottleJob(options=options, slot=slot, owner=owner)
+    job = job_class(options=options, slot=slot, **kwargs)
+
+    # follow-ons wait for the throttle children added by each new attempt
+    throttle.addFollowOn(job)
+    parent.addChild(throttle)
+    return job
+
+
+class SampleJob(ContainerJob):
+    def __init__(self, options, sample, **kwargs):
+        """
+        Add the typing jobs of a sample.
+
+        If the sample has a downsampling target, a `DownsampleJob` is added
+        instead, which adds the typing jobs for the downsampled BAM.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+            sample (utils.Sample): sample to be typed.
+        """
+        self.sample = sample
+
+        super().__init__(
+            memory=kwargs.pop("memory", "1G"),
+            options=options,
+            cores=kwargs.pop("cores", 1),
+            runtime=kwargs.pop("runtime", 90),
+            **kwargs,
+        )
+
+    def run(self, fileStore):
+        """Run the job."""
+        size_gb = utils.get_size_gb(self.sample.bamfile)
+        timings_dir = utils.get_timings_dir(
+            self.options, self.sample.sample_id, self.sample.kind
+        )
+
+        # timings of previous runs would be mixed with the ones of this run
+        if isdir(timings_dir):
+            shutil.rmtree(timings_dir)
+
+        if utils.get_downsample_target(self.sample, self.options) is None:
+            add_typing_jobs(self, self.options, self.sample, self.sample.bamfile)
+        else:
+            self.addChild(
+                DownsampleJob(
+                    options=self.options,
+                    sample=self.sample,
+                    estimate=utils.estimate_runtime("downsample", size_gb),
+                )
+            )
+
+        self.addFollowOn(
+            MakespanJob(
+                options=self.options,
+                sample=self.sample,
+                start_time=time.time(),
+                size_gb=size_gb,
+            )
+        )
+
+
+class MakespanJob(ContainerJob):
+    def __init__(self, options, sample, start_time, size_gb, **kwargs):
+        """
+        Report the makespan of a sample once all its jobs are done.
+
+        The makespan is compared against the measured critical path, its
+        lower bound, and the sum of all job runtimes, its serial upper bound.
+        The scheduling delay is the time the critical path spent waiting.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+            sample (utils.Sample): typed sample.
+            start_time (float): epoch time when the sample jobs were added.
+            size_gb (float): size of the input BAM in GB.
+        """
+        self.sample = sample
+        self.start_time = start_time
+        self.size_gb = size_gb
+        self.makespan_dir = join(options.outdir, "makespan", sample.kind.lower())
+
+        super().__init__(
+            memory=kwargs.pop("memory", "1G"),
+            options=options,
+            cores=kwargs.pop("cores", 1),
+            runtime=kwargs.pop("runtime", 90),
+            **kwargs,
+        )
+
+    def run(self, fileStore):
+        """Run the job."""
+        if not isdir(self.makespan_dir):
+            os.makedirs(self.makespan_dir)
+
+        timings = utils.read_timings(
+            self.options, self.sample.sample_id, self.sample.kind
+        )
+        estimates = {step: estimate for step, estimate, _, _ in timings}
+        durations = {step: (end - start) / 60 for step, _, start, end in timings}
+        end_time = max([i[3] for i in timings] or [time.time()])
+        makespan = (end_time - self.start_time) / 60
+        critical_path = utils.get_critical_path(durations)
+        makespan_file = join(self.makespan_dir, f"{self.sample.sample_id}.tsv")
+
+        with open(makespan_file, "w", encoding="utf-8") as f:
+            f.write(
+                "sample_id\ttype\tinput_gb\testimated_critical_path_minutes\t"
+                "critical_path_minutes\tserial_minutes\tmakespan_minutes\t"
+                "scheduling_delay_minutes\n"
+            )
+            f.write(
+                f"{self.sample.sample_id}\t{self.sample.kind}\t{self.size_gb:.2f}\t"
+                f"{utils.get_critical_path(estimates):.0f}\t{critical_path:.2f}\t"
+                f"{sum(durations.values()):.2f}\t{makespan:.2f}\t"
+                f"{makespan - critical_path:.2f}\n"
+            )
+
+
+class ThrottleJob(ContainerJob):
+    def __init__(self, options, slot, owner, first_attempt=None, **kwargs):
+        """
+        Acquire a concurrency slot for a capped job, its follow-on.
+
+        Each attempt polls for a free slot during `--throttle-poll` minutes,
+        waiting `--throttle-wait` seconds between polls and doubling the wait
+        up to `constants.THROTTLE_MAX_WAIT`. If no slot is freed, a new
+        attempt is added as a child, thus cores are freed periodically so
+        that capped jobs that already own a slot can be scheduled, and the
+        chain of attempts is at most `--throttle-timeout` / `--throttle-poll`
+        jobs deep. Attempts fail after `--throttle-timeout` minutes.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+            slot (utils.Slot): slot to acquire.
+            owner (str): description of the capped job.
+            first_attempt (float): epoch time of the first attempt.
+        """
+        self.slot = slot
+        self.owner = owner
+        self.first_attempt = first_attempt
+
+        super().__init__(
+            memory=kwargs.pop("memory", "1G"),
+            options=options,
+            cores=kwargs.pop("cores", 1),
+            runtime=kwargs.pop("runtime", 90),
+            **kwargs,
+        )
+
+    def run(self, fileStore):
+        """Run the job."""
+        first_attempt = self.first_attempt or time.time()
+        timeout = first_attempt + self.options.throttle_timeout * 60
+        poll_until = min(time.time() + self.options.throttle_poll * 60, timeout)
+        wait = self.options.throttle_wait
+
+        while not utils.acquire_slot(self.options, self.slot, self.owner):
+            if time.time() >= timeout:
+                raise exceptions.ThrottleTimeoutError(
+                    f"No {self.slot.tool} slot was freed in "
+                    f"{self.options.throttle_timeout} minutes for: {self.owner}"
+                )
+
+            if time.time() >= poll_until:
+                self.addChild(
+                    ThrottleJob(
+                        options=self.options,
+                        slot=self.slot,
+                        owner=self.owner,
+                        first_attempt=first_attempt,
+                    )
+                )
+                return
+
+            time.sleep(max(min(wait, poll_until - time.time()), 0))
+            wait = min(wait * 2, constants.THROTTLE_MAX_WAIT)
+
+
+class DownsampleJob(ContainerJob):
+    def __init__(self, options, sample, **kwargs):
+        """
+        Downsample the MHC region and unmapped reads of a BAM file.
+
+        DNA is downsampled to a target mean MHC depth and RNA to a target
+        number of MHC reads, see `utils.get_downsample_target`. The typing
+        jobs are added once the downsampled BAM size is known.
+
+        Arguments:
+            kwargs (dict): extra ContainerJob key word arguments.
+            options (object): toil_hla options structure.
+            sample (utils.Sample): sample to be downsampled.
+            estimate (int): expected minutes, see `utils.estimate_runtime`.
+        """
+        self.sample = sample
+        self.bamfile = sample.bamfile
+        self.sample_id = sample.sample_id
+        self.kind = sample.kind
+        self.estimate = kwargs.pop("estimate", None)
+        self.downsampled_bam = utils.get_downsampled_bam(options.outdir, sample)
+
+        self.downsample_dir = dirname(self.downsampled_bam)
+        self.samtools = options.samtools
+        self.mhc_region = options.mhc_region
+        self.downsample_seed = options.downsample_seed
+        self.target = utils.get_downsample_target(sample, options)
+
+        super().__init__(
+            memory=kwargs.pop("memory", "4G"),
+            options=options,
+            cores=kwargs.pop("cores", 4),
+            runtime=kwargs.pop("runtime", utils.get_runtime_hint(self.estimate)),
+            **kwargs,
+        )
+
+    def get_value(self, bamfile):
+        """Get the MHC depth for DNA or the number of MHC reads for RNA."""
+        if self.kind == "RNA":
+            return utils.get_region_reads(self.samtools, bamfile, self.mhc_region)
+        return utils.get_region_depth(self.samtools, bamfile, self.mhc_region)
+
+    def run(self, fileStore):
+        """Run the job."""
+        with utils.record_timing(
+            self.options, self.sample_id, self.kind, "downsample", self.estimate
+        ):
+            self.downsample(fileStore)
+
+        add_typing_jobs(self, self.options, self.sample, self.downsampled_bam)
+
+    def downsample(self, fileStore):
+        """Write the downsampled BAM and its depth report."""
+        if not isdir(self.downsample_dir):
+            os.makedirs(self.downsample_dir)
+
+        value = self.get_value(self.bamfile)
+        fraction = utils.get_downsample_fraction(value, self.target)
+
+        for i in self.downsampled_bam, self.downsampled_bam + ".bai":
+            if os.path.lexists(i):
+                os.remove(i)
+
+        if fraction < 1:
+            # typers only read the MHC and unmapped reads, keeping the output
+            # small regardless of the input size, `*` are the unmapped reads,
+            # --fetch-pairs keeps MHC reads whose mate maps outside the region
+            tmpdir = fileStore.getLocalTempDir()
+            parts = []
+
+            for i, region in enumerate([self.mhc_region, "*"]):
+                parts.append(join(tmpdir, f"{i}.bam"))
+                cmd = [
+                    self.samtools,
+                    "view",
+                    "-b",
+                    *(["--fetch-pairs"] if region != "*" else []),
+                    "-@",
+                    str(self.cores),
+                    "-s",
+                    utils.get_subsample_arg(self.downsample_seed, fraction),
+                    "-o",
+                    parts[-1],
+                    self.bamfile,
+                    region,
+                ]
+
+                subprocess.check_call(cmd, cwd=tmpdir)
+
+            # unmapped reads sort last, thus the concatenation is still sorted
+            subprocess.check_call(
+                [self.samtools, "cat", "-o", self.downsampled_bam] + parts,
+                cwd=self.downsample_dir,
+            )
+            subprocess.check_call(
+                [self.samtools, "index", self.downsampled_bam],
+                cwd=self.downsample_dir,
+            )
+        else:
+            os.symlink(self.bamfile, self.downsampled_bam)
+            os.symlink(self.bamfile + ".bai", self.downsampled_bam + ".bai")
+
+        achieved = self.get_value(self.downsampled_bam)
+        metric = "reads" if self.kind == "RNA" else "depth"
+
+        depth_file = join(self.downsample_dir, f"{self.sample_id}.depth.tsv")
+        with open(depth_file, "w", encoding="utf-8") as f:
+            f.write("sample_id\tregion\tmetric\tinput\ttarget\tfraction\tachieved\n")
+            f.write(
+                f"{self.sample_id}\t{self.mhc_region}\t{metric}\t{value:.2f}\t"
+                f"{self.target:.2f}\t{fraction:.6f}\t{achieved:.2f}\n"
+            )
+
+
 class LilacJob(ContainerJob):
     def __init__(self, options, bamfile, sample_id, **kwargs):
         """
@@ -34,14 +513,15 @@ class LilacJob(ContainerJob):
             options (object): toil_hla options structure.
             bamfile (str): path to BAM file.
             sample_id (str): sample ID.
+            slot (utils.Slot): concurrency slot held while running.
+            estimate (int): expected minutes, see `utils.estimate_runtime`.
         """
         self.bamfile = bamfile
         self.sample_id = sample_id
+        self.slot = kwargs.pop("slot", None)
+        self.estimate = kwargs.pop("estimate", None)
 
         self.lilac_dir = join(options.outdir, "lilac")
-        if not isdir(self.lilac_dir):
-            os.makedirs(self.lilac_dir)
-
         self.lilac_img = options.lilac_img
         self.lilac_resource_dir = options.lilac_resource_dir
 
@@ -49,7 +529,7 @@ class LilacJob(ContainerJob):
             memory="20G",
             options=options,
             cores=kwargs.pop("cores", 1),
-            runtime=kwargs.pop("runtime", 90),
+            runtime=kwargs.pop("runtime", utils.get_runtime_hint(self.estimate)),
             **kwargs,
         )
 
@@ -73,7 +553,10 @@ class LilacJob(ContainerJob):
             outdir,
         ]
 
-        self.call(cmd, cwd=outdir)
+        with utils.hold_slot(self.options, self.slot), utils.record_timing(
+            self.options, self.sample_id, "DNA", "lilac", self.estimate
+        ):
+            self.call(cmd, cwd=outdir)
 
 
 class HLAscanJob(ContainerJob):
@@ -88,15 +571,16 @@ class HLAscanJob(ContainerJob):
             bamfile (str): path to BAM file.
             sample_id (str): sample ID.
             gene (str): gene name.
+            slot (utils.Slot): concurrency slot held while running.
+            estimate (int): expected minutes, see `utils.estimate_runtime`.
         """
         self.bamfile = bamfile
         self.sample_id = sample_id
         self.gene = gene
+        self.slot = kwargs.pop("slot", None)
+        self.estimate = kwargs.pop("estimate", None)
 
         self.hlascan_dir = join(options.outdir, "hlascan")
-        if not isdir(self.hlascan_dir):
-            os.makedirs(self.hlascan_dir)
-
         self.hlascan_tool = options.hlascan_tool
         self.hlascan_resource_dir = options.hlascan_resource_dir
 
@@ -104,7 +588,7 @@ class HLAscanJob(ContainerJob):
             memory="20G",
             options=options,
             cores=kwargs.pop("cores", 1),
-            runtime=kwargs.pop("runtime", 90),
+            runtime=kwargs.pop("runtime", utils.get_runtime_hint(self.estimate)),
             **kwargs,
         )
 
@@ -129,7 +613,11 @@ class HLAscanJob(ContainerJob):
         ]
 
         # Open a log file for writing
-        with open(join(outdir, f"{self.gene}.txt"), "w", encoding="utf-8") as log_file:
+        log_path = join(outdir, f"{self.gene}.txt")
+        step = f"hlascan.{self.gene}"
+        with utils.hold_slot(self.options, self.slot), utils.record_timing(
+            self.options, self.sample_id, "DNA", step, self.estimate
+        ), open(log_path, "w", encoding="utf-8") as log_file:
             try:
                 subprocess.check_call(cmd, cwd=outdir, stdout=log_file)
             except subprocess.CalledProcessError as _:
@@ -146,25 +634,23 @@ class RNAJob(ContainerJob):
             options (object): toil_hla options structure.
             bamfile (str): path to BAM file.
             sample_id (str): sample id.
+            slot (utils.Slot): concurrency slot held while running.
+            estimate (int): expected minutes, see `utils.estimate_runtime`.
         """
         self.bamfile = bamfile
         self.sample_id = sample_id
+        self.slot = kwargs.pop("slot", None)
+        self.estimate = kwargs.pop("estimate", None)
 
         self.arcashla_dir = join(options.outdir, "arcashla")
-        if not isdir(self.arcashla_dir):
-            os.makedirs(self.arcashla_dir)
-
         self.seq2hla_dir = join(options.outdir, "seq2hla")
-        if not isdir(self.seq2hla_dir):
-            os.makedirs(self.seq2hla_dir)
-
         self.arcashla_img = options.arcashla_img
         self.seq2hla_img = options.seq2hla_img
 
         super().__init__(
             options=options,
             cores=kwargs.pop("cores", 8),
-            runtime=kwargs.pop("runtime", 90),
+            runtime=kwargs.pop("runtime", utils.get_runtime_hint(self.estimate)),
             memory=kwargs.pop("memory", "20G"),
             **kwargs,
         )
@@ -204,7 +690,10 @@ class ArcasHLAExtract(RNAJob):
             "-v",
         ]
 
-        self.call(cmd, cwd=self.arcashla_dir)
+        with utils.hold_slot(self.options, self.slot), utils.record_timing(
+            self.options, self.sample_id, "RNA", "arcashla_extract", self.estimate
+        ):
+            self.call(cmd, cwd=self.arcashla_dir)
 
 
 class ArcasHLAGenotype(RNAJob):
@@ -246,7 +735,10 @@ class ArcasHLAGenotype(RNAJob):
             "-v",
         ]
 
-        self.call(cmd, cwd=outdir)
+        with utils.hold_slot(self.options, self.slot), utils.record_timing(
+            self.options, self.sample_id, "RNA", "arcashla_genotype", self.estimate
+        ):
+            self.call(cmd, cwd=outdir)
 
 
 class Seq2HLAJob(RNAJob):
@@ -288,4 +780,7 @@ class Seq2HLAJob(RNAJob):
             self.sample_id,
         ]
 
-        self.call(cmd, cwd=outdir)
+        with utils.record_timing(
+            self.options, self.sample_id, "RNA", "seq2hla", self.estimate
+        ):
+            self.call(cmd, cwd=outdir)
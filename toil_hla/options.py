@@ -1,5 +1,6 @@
 """toil_hla options."""
 
+import os
 import subprocess
 
 # from pysam import AlignmentFile
@@ -7,6 +8,7 @@ from toil_container import ContainerArgumentParser
 import click
 
 from toil_hla import __version__
+from toil_hla import constants
 from toil_hla import validators
 
 
@@ -75,6 +77,24 @@ def get_parser():
         type=str,
     )
 
+    settings.add_argument(
+        "--samples",
+        help="Tab separated file with more samples to type, with columns "
+        "sample_id, bamfile and type (DNA or RNA). Relative BAM paths are "
+        "resolved against the file directory.",
+        required=False,
+        type=validators.validate_samples,
+    )
+
+    settings.add_argument(
+        "--max-samples-in-flight",
+        help="Number of independent chains typing samples, each chain claims "
+        "the next sample of the queue once its previous sample is done.",
+        required=False,
+        default=10,
+        type=int,
+    )
+
     # Lilac args
     settings.add_argument(
         "--lilac-img",
@@ -117,6 +137,109 @@ def get_parser():
         required=False,
     )
 
+    # downsampling args
+    settings.add_argument(
+        "--downsample-depth",
+        help="Downsample DNA read pairs to this mean MHC depth before typing. "
+        "Inputs already below the target are used as they are.",
+        required=False,
+        type=float,
+    )
+
+    settings.add_argument(
+        "--downsample-rna-reads",
+        help="Downsample RNA read pairs to this number of MHC reads before "
+        "typing. Inputs already below the target are used as they are.",
+        required=False,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--downsample-seed",
+        help="Seed used to select read pairs when downsampling.",
+        required=False,
+        default=42,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--mhc-region",
+        help="Region used to estimate depth before downsampling, only reads "
+        "in this region and unmapped reads are kept in downsampled BAMs.",
+        required=False,
+        default=constants.MHC_REGION,
+    )
+
+    settings.add_argument(
+        "--samtools",
+        help="samtools binary, used when downsampling (version 1.16 or later).",
+        required=False,
+        default="samtools",
+    )
+
+    # concurrency args
+    for tool in constants.THROTTLED_TOOLS:
+        settings.add_argument(
+            f"--max-{tool}-jobs",
+            help=f"Maximum number of {tool} jobs running at once across all "
+            "workers. Jobs over the limit wait in a low resource job.",
+            required=False,
+            type=int,
+        )
+
+    settings.add_argument(
+        "--lock-dir",
+        help="Shared directory used to enforce --max-*-jobs limits "
+        "[default: OUTDIR/locks]. Use the same directory across runs to share "
+        "limits between them.",
+        required=False,
+        type=click.Path(dir_okay=True, writable=True, resolve_path=True),
+    )
+
+    settings.add_argument(
+        "--throttle-wait",
+        help="Seconds to wait between polls for a free slot of a capped job, "
+        "the wait doubles after each poll up to 5 minutes.",
+        required=False,
+        default=30,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--throttle-poll",
+        help="Minutes a low resource job polls for a free slot before it is "
+        "replaced by a new one, freeing its core in between.",
+        required=False,
+        default=15,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--throttle-timeout",
+        help="Minutes after which a capped job that couldn't start fails.",
+        required=False,
+        default=1440,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--slot-lease",
+        help="Minutes after which a slot that isn't refreshed by its running "
+        "job is considered stale and reclaimed.",
+        required=False,
+        default=60,
+        type=int,
+    )
+
+    settings.add_argument(
+        "--slot-grant-timeout",
+        help="Minutes a slot acquired for a capped job is kept while the job "
+        "waits to be scheduled, after which it can be reclaimed.",
+        required=False,
+        default=240,
+        type=int,
+    )
+
     return parser
 
 
@@ -124,4 +247,37 @@ def process_parsed_options(options):
     """Perform validations and add post parsing attributes to `options`."""
     if options.writeLogs is not None:
         subprocess.check_call(["mkdir", "-p", options.writeLogs])
+
+    if options.downsample_depth is not None and options.downsample_depth <= 0:
+        raise click.UsageError("--downsample-depth should be greater than 0.")
+
+    if options.downsample_rna_reads is not None and options.downsample_rna_reads <= 0:
+        raise click.UsageError("--downsample-rna-reads should be greater than 0.")
+
+    if options.max_samples_in_flight <= 0:
+        raise click.UsageError("--max-samples-in-flight should be greater than 0.")
+
+    throttled = False
+    for tool in constants.THROTTLED_TOOLS:
+        max_jobs = getattr(options, f"max_{tool}_jobs")
+        if max_jobs is not None and max_jobs <= 0:
+            raise click.UsageError(f"--max-{tool}-jobs should be greater than 0.")
+        throttled = throttled or max_jobs is not None
+
+    for i in [
+        "throttle_wait",
+        "throttle_poll",
+        "throttle_timeout",
+        "slot_lease",
+        "slot_grant_timeout",
+    ]:
+        if getattr(options, i) <= 0:
+            flag = "--" + i.replace("_", "-")
+            raise click.UsageError(f"{flag} should be greater than 0.")
+
+    if options.lock_dir is None:
+        options.lock_dir = os.path.join(options.outdir, "locks")
+    if throttled:
+        subprocess.check_call(["mkdir", "-p", options.lock_dir])
+
     return options
@@ -1 +1,678 @@
 """toil_hla utils."""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from glob import glob
+from os.path import dirname
+from os.path import join
+import fcntl
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+from toil_hla import constants
+from toil_hla import exceptions
+
+# a sample to be typed, kind is either DNA or RNA
+Sample = namedtuple("Sample", ["sample_id", "bamfile", "kind"])
+
+# a concurrency slot of a capped tool, the token identifies the owner job
+Slot = namedtuple("Slot", ["tool", "max_jobs", "token"])
+
+# columns expected in the --samples file
+SAMPLES_COLUMNS = ["sample_id", "bamfile", "type"]
+
+
+def get_cli_samples(options):
+    """
+    Get the samples passed with `--normal-dna`, `--tumor-dna` and `--tumor-rna`.
+
+    Arguments:
+        options (object): toil_hla options structure.
+
+    Returns:
+        list: list of `Sample`.
+    """
+    return [
+        Sample(sample_id=sample_id, bamfile=bamfile, kind=kind)
+        for sample_id, bamfile, kind in [
+            (options.normal_dna_id, options.normal_dna, "DNA"),
+            (options.tumor_dna_id, options.tumor_dna, "DNA"),
+            (options.tumor_rna_id, options.tumor_rna, "RNA"),
+        ]
+        if bamfile and sample_id
+    ]
+
+
+def parse_samples_line(line, path):
+    """
+    Parse a `--samples` file line, missing fields are parsed as empty strings.
+
+    Arguments:
+        line (str): tab separated line.
+        path (str): path to the samples file, relative BAMs are resolved
+            against its directory.
+
+    Returns:
+        Sample: the parsed sample, see `validators.validate_sample`.
+
+    Examples:
+        >>> parse_samples_line("s1\\tbams/s1.bam\\tdna\\n", "/data/samples.tsv")
+        Sample(sample_id='s1', bamfile='/data/bams/s1.bam', kind='DNA')
+        >>> parse_samples_line("s1\\n", "/data/samples.tsv")
+        Sample(sample_id='s1', bamfile='', kind='')
+    """
+    fields = line.rstrip("\r\n").split("\t") + ["", ""]
+    sample_id, bamfile, kind = [i.strip() for i in fields[:3]]
+    bamfile = os.path.abspath(join(dirname(path), bamfile)) if bamfile else ""
+    return Sample(sample_id=sample_id, bamfile=bamfile, kind=kind.upper())
+
+
+def get_queue_dir(options):
+    """Get the directory where the samples queue state is kept."""
+    return join(options.outdir, ".queue")
+
+
+def reset_samples_queue(options):
+    """
+    Reset the samples queue so that a new run starts from the first sample.
+
+    Arguments:
+        options (object): toil_hla options structure.
+    """
+    queue_dir = get_queue_dir(options)
+
+    if os.path.isdir(queue_dir):
+        shutil.rmtree(queue_dir)
+
+    if os.path.isfile(get_invalid_samples_file(options)):
+        os.remove(get_invalid_samples_file(options))
+
+    for kind in "DNA", "RNA":
+        os.makedirs(join(queue_dir, "samples", kind))
+
+
+def claim_next_sample(options, chain, token, attempt):
+    """
+    Claim the next sample of the queue for a chain of sample jobs.
+
+    Samples passed in the command line are claimed first, followed by the
+    `--samples` file, which is read from the byte offset kept in the queue
+    state. Claims are recorded by `token`, thus a retried job claims the same
+    samples again instead of skipping them.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        chain (int): chain index.
+        token (str): token of the claiming job.
+        attempt (int): number of samples already claimed by the job.
+
+    Returns:
+        Sample: the claimed sample, None if the queue is empty.
+    """
+    queue_dir = get_queue_dir(options)
+    state_file = join(queue_dir, "state.json")
+
+    with open(join(queue_dir, "state.lock"), "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"index": 0, "offset": 0, "claims": {}}
+
+        claims = state["claims"].get(str(chain))
+        if not claims or claims["token"] != token:
+            claims = state["claims"][str(chain)] = {"token": token, "samples": []}
+
+        if attempt < len(claims["samples"]):
+            sample = claims["samples"][attempt]
+            return Sample(*sample) if sample else None
+
+        cli_samples = get_cli_samples(options)
+        sample = None
+
+        if state["index"] < len(cli_samples):
+            sample = cli_samples[state["index"]]
+            state["index"] += 1
+        elif options.samples:
+            with open(options.samples, "rb") as f:
+                if not state["offset"]:
+                    f.readline()  # skip header
+                else:
+                    f.seek(state["offset"])
+
+                for line in iter(f.readline, b""):
+                    if line.strip():
+                        sample = parse_samples_line(line.decode("utf-8"), f.name)
+                        break
+
+                state["offset"] = f.tell()
+
+        claims["samples"].append(sample)
+        with open(state_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(state_file + ".tmp", state_file)
+
+    return sample
+
+
+def mark_sample(options, sample, token):
+    """
+    Mark `sample` as claimed by `token` to detect duplicated samples.
+
+    Samples are keyed by ID and type, thus the DNA and RNA of a sample can
+    share an ID.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        sample (Sample): claimed sample, validated by `validate_sample`.
+        token (str): token of the claiming job.
+
+    Returns:
+        bool: False if the sample was already claimed by another job.
+    """
+    marker = join(get_queue_dir(options), "samples", sample.kind, sample.sample_id)
+
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(marker, "r", encoding="utf-8") as f:
+            return f.read() == token
+
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+
+    return True
+
+
+def get_invalid_samples_file(options):
+    """Get the path to the file where invalid samples are reported."""
+    return join(options.outdir, "invalid_samples.tsv")
+
+
+def get_size_gb(path):
+    """Get the size of a file in GB, following symlinks."""
+    return os.path.getsize(path) / 1e9
+
+
+def estimate_runtime(step, size_gb):
+    """
+    Estimate the runtime of a step from the size of its input BAM.
+
+    Arguments:
+        step (str): a key of `constants.EXPECTED_RUNTIMES`.
+        size_gb (float): size of the input BAM in GB.
+
+    Returns:
+        int: expected minutes.
+
+    Examples:
+        >>> estimate_runtime("lilac", 100)
+        30
+    """
+    minutes, minutes_per_gb = constants.EXPECTED_RUNTIMES[step]
+    return int(math.ceil(minutes + minutes_per_gb * size_gb))
+
+
+def get_runtime_hint(estimate):
+    """
+    Get the runtime passed to the batch system for a job estimate.
+
+    Estimates aren't calibrated yet, thus the hint is never lower than the
+    90 minutes all jobs used to get.
+
+    Arguments:
+        estimate (int): expected minutes, None if unknown.
+
+    Returns:
+        int: runtime in minutes, see `constants.RUNTIME_HINT_MARGIN`.
+
+    Examples:
+        >>> get_runtime_hint(6)
+        90
+        >>> get_runtime_hint(60)
+        120
+    """
+    if estimate is None:
+        return 90
+    return max(90, int(estimate * constants.RUNTIME_HINT_MARGIN))
+
+
+def get_critical_path(durations):
+    """
+    Get the longest chain of dependent steps of a sample.
+
+    Arguments:
+        durations (dict): minutes by step name, steps of the same tool are
+            named `{step}.{suffix}` (e.g. `hlascan.HLA-A`).
+
+    Returns:
+        float: minutes of the longest chain, missing steps count as 0.
+
+    Examples:
+        >>> get_critical_path({"lilac": 30, "hlascan.HLA-A": 10})
+        30
+        >>> get_critical_path(
+        ...     {"downsample": 5, "arcashla_extract": 10, "seq2hla": 40}
+        ... )
+        55
+    """
+
+    def get(step):
+        return max(
+            [v for k, v in durations.items() if k.split(".")[0] == step] or [0]
+        )
+
+    rna_path = get("arcashla_extract") + max(get("arcashla_genotype"), get("seq2hla"))
+    return get("downsample") + max(get("lilac"), get("hlascan"), rna_path)
+
+
+def get_timings_dir(options, sample_id, kind):
+    """
+    Get the directory where the step timings of a sample are kept.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        sample_id (str): sample ID.
+        kind (str): DNA or RNA.
+
+    Returns:
+        str: `OUTDIR/makespan/{kind}/{sample_id}` with a lower case kind.
+    """
+    return join(options.outdir, "makespan", kind.lower(), sample_id)
+
+
+@contextmanager
+def record_timing(options, sample_id, kind, step, estimate):
+    """
+    Record the estimated and actual runtime of a step once it succeeds.
+
+    Timings are written to `get_timings_dir` as `{step}.tsv` and summarized
+    by `jobs.MakespanJob`.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        sample_id (str): sample ID.
+        kind (str): DNA or RNA.
+        step (str): step name, see `get_critical_path`.
+        estimate (int): expected minutes, None if unknown.
+    """
+    start = time.time()
+    yield
+    end = time.time()
+    timings_dir = get_timings_dir(options, sample_id, kind)
+
+    if not os.path.isdir(timings_dir):
+        os.makedirs(timings_dir, exist_ok=True)
+
+    with open(join(timings_dir, f"{step}.tsv"), "w", encoding="utf-8") as f:
+        f.write("step\testimate_minutes\tstart\tend\n")
+        f.write(f"{step}\t{estimate or ''}\t{start:.0f}\t{end:.0f}\n")
+
+
+def read_timings(options, sample_id, kind):
+    """
+    Read the timings recorded by `record_timing` for a sample.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        sample_id (str): sample ID.
+        kind (str): DNA or RNA.
+
+    Returns:
+        list: tuples of step, estimated minutes, start and end epoch times.
+    """
+    timings_dir = get_timings_dir(options, sample_id, kind)
+    timings = []
+
+    for i in sorted(glob(join(timings_dir, "*.tsv"))):
+        with open(i, "r", encoding="utf-8") as f:
+            step, estimate, start, end = f.readlines()[1].rstrip("\n").split("\t")
+            estimate = float(estimate) if estimate else 0
+            timings.append((step, estimate, float(start), float(end)))
+
+    return timings
+
+
+def get_downsample_target(sample, options):
+    """
+    Get the downsampling target of a sample.
+
+    DNA samples are downsampled to `--downsample-depth` mean MHC depth. Mean
+    depth over the MHC is dominated by intronic zeros in RNA, thus RNA samples
+    are downsampled to `--downsample-rna-reads` MHC reads instead.
+
+    Arguments:
+        sample (Sample): sample to be typed.
+        options (object): toil_hla options structure.
+
+    Returns:
+        float: target depth or reads, None if the sample isn't downsampled.
+    """
+    if sample.kind == "RNA":
+        return options.downsample_rna_reads
+    return options.downsample_depth
+
+
+def get_downsampled_bam(outdir, sample):
+    """
+    Get the path to the downsampled BAM of a sample.
+
+    Arguments:
+        outdir (str): pipeline output directory.
+        sample (Sample): sample to be downsampled.
+
+    Returns:
+        str: path to the downsampled BAM file.
+
+    Examples:
+        >>> get_downsampled_bam("/out", Sample("s1", "s1.bam", "RNA"))
+        '/out/downsample/rna/s1/s1.downsampled.bam'
+    """
+    sample_id = sample.sample_id
+    return join(
+        outdir,
+        "downsample",
+        sample.kind.lower(),
+        sample_id,
+        f"{sample_id}.downsampled.bam",
+    )
+
+
+def get_region_depth(samtools, bamfile, region):
+    """
+    Estimate the mean depth of a BAM file across a region.
+
+    Arguments:
+        samtools (str): samtools executable.
+        bamfile (str): path to indexed BAM file.
+        region (str): region in `contig:start-end` format.
+
+    Returns:
+        float: mean depth across the region.
+    """
+    cmd = [samtools, "coverage", "--no-header", "-r", region, bamfile]
+    output = subprocess.check_output(cmd).decode("utf-8").strip()
+
+    # columns are rname, startpos, endpos, numreads, covbases, coverage,
+    # meandepth, meanbaseq and meanmapq
+    return float(output.splitlines()[-1].split("\t")[6])
+
+
+def get_region_reads(samtools, bamfile, region):
+    """
+    Count the primary reads of a BAM file in a region.
+
+    Arguments:
+        samtools (str): samtools executable.
+        bamfile (str): path to indexed BAM file.
+        region (str): region in `contig:start-end` format.
+
+    Returns:
+        int: number of primary, non supplementary, mapped reads.
+    """
+    cmd = [samtools, "view", "-c", "-F", "0x904", bamfile, region]
+    return int(subprocess.check_output(cmd).decode("utf-8").strip())
+
+
+def get_downsample_fraction(value, target):
+    """
+    Get the fraction of read pairs to keep to go from `value` to `target`.
+
+    The fraction is rounded to the 6 decimals samtools is given, fractions
+    that round to 1 mean no downsampling is needed.
+
+    Arguments:
+        value (float): current depth or number of reads.
+        target (float): desired depth or number of reads.
+
+    Returns:
+        float: fraction of read pairs to keep, 1 if no downsampling is needed.
+
+    Examples:
+        >>> get_downsample_fraction(300, 75)
+        0.25
+        >>> get_downsample_fraction(30, 75)
+        1.0
+        >>> get_downsample_fraction(1000000.1, 1000000)
+        1.0
+    """
+    if value <= target:
+        return 1.0
+    return max(round(target / value, 6), 1e-6)
+
+
+def get_subsample_arg(seed, fraction):
+    """
+    Format the samtools `-s INT.FRAC` subsampling argument.
+
+    Samtools hashes read names with the seed, thus mates are kept together
+    and the same reads are selected on every run.
+
+    Arguments:
+        seed (int): subsampling seed.
+        fraction (float): fraction of read pairs to keep, lower than 1.
+
+    Returns:
+        str: the samtools subsampling argument.
+
+    Examples:
+        >>> get_subsample_arg(42, 0.25)
+        '42.250000'
+        >>> get_subsample_arg(42, 0.9999999)
+        '42.999999'
+    """
+    # clamp so that formatting never rounds up to 1, read as a fraction of 0
+    fraction = min(max(fraction, 1e-6), 0.999999)
+    return f"{seed}" + f"{fraction:.6f}"[1:]
+
+
+def get_slot_token(path):
+    """
+    Get the token of the job that owns a slot file.
+
+    Arguments:
+        path (str): path to a slot file.
+
+    Returns:
+        str: owner token, None if the slot doesn't exist.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().split(" ", 1)[0].strip()
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def lock_slots(lock_dir, tool):
+    """
+    Hold an exclusive lock on the slots of `tool` while the context runs.
+
+    Arguments:
+        lock_dir (str): directory where slots are kept.
+        tool (str): tool name.
+    """
+    with open(join(lock_dir, f"{tool}.lock"), "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def is_stale_slot(path, lease):
+    """
+    Check if a slot file hasn't been refreshed within `lease` seconds.
+
+    Arguments:
+        path (str): path to a slot file.
+        lease (float): seconds after which a slot is considered stale.
+
+    Returns:
+        bool: True if the slot exists and is stale.
+    """
+    try:
+        return time.time() - os.path.getmtime(path) >= lease
+    except FileNotFoundError:
+        return False
+
+
+def reclaim_stale_slot(lock_dir, tool, path, lease):
+    """
+    Remove a slot file that hasn't been refreshed within `lease` seconds.
+
+    Slots are refreshed by `hold_slot` while their job runs, stale slots are
+    left by jobs that were killed or failed before they could release them.
+    The check and removal run under `lock_slots`, thus a slot recreated by
+    another worker after the check can't be removed.
+
+    Arguments:
+        lock_dir (str): directory where slots are kept.
+        tool (str): tool name.
+        path (str): path to a slot file.
+        lease (float): seconds after which a slot is considered stale.
+
+    Returns:
+        bool: True if the slot was stale and removed.
+    """
+    with lock_slots(lock_dir, tool):
+        if not is_stale_slot(path, lease):
+            return False
+
+        os.remove(path)
+        return True
+
+
+def acquire_slot(options, slot, owner=""):
+    """
+    Try to acquire one of `slot.max_jobs` concurrency slots for `slot.tool`.
+
+    Slots are files created exclusively in `--lock-dir`, thus the limit holds
+    across workers and hosts as long as the directory is on shared storage.
+    Slots not refreshed within `--slot-lease` minutes are reclaimed. A new
+    slot's mtime is set `--slot-grant-timeout` minutes ahead, so that it
+    isn't reclaimed while its job waits to be scheduled.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        slot (Slot): slot to acquire, its token identifies the owner job.
+        owner (str): description of the owner, written to the slot.
+
+    Returns:
+        str: path to the acquired slot, None if all slots are taken.
+    """
+    paths = [
+        join(options.lock_dir, f"{slot.tool}.{i}.slot") for i in range(slot.max_jobs)
+    ]
+
+    with lock_slots(options.lock_dir, slot.tool):
+        for path in paths:
+            if get_slot_token(path) == slot.token:
+                return path
+
+        for path in paths:
+            if is_stale_slot(path, options.slot_lease * 60):
+                os.remove(path)
+
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(
+                    f"{slot.token} {owner} {socket.gethostname()} {os.getpid()}\n"
+                )
+
+            granted_until = time.time() + options.slot_grant_timeout * 60
+            os.utime(path, (granted_until, granted_until))
+            return path
+
+    return None
+
+
+def release_slot(options, slot):
+    """
+    Release the slot owned by `slot.token`, if any.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        slot (Slot): slot to release, ignored if None.
+    """
+    if not slot:
+        return
+
+    with lock_slots(options.lock_dir, slot.tool):
+        for i in range(slot.max_jobs):
+            path = join(options.lock_dir, f"{slot.tool}.{i}.slot")
+
+            if get_slot_token(path) == slot.token:
+                os.remove(path)
+
+
+def refresh_slot(options, slot):
+    """
+    Refresh the slot owned by `slot.token` so that it isn't reclaimed.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        slot (Slot): slot to refresh.
+
+    Returns:
+        str: path to the refreshed slot, None if the job doesn't own a slot.
+    """
+    with lock_slots(options.lock_dir, slot.tool):
+        for i in range(slot.max_jobs):
+            path = join(options.lock_dir, f"{slot.tool}.{i}.slot")
+
+            if get_slot_token(path) == slot.token:
+                os.utime(path)
+                return path
+
+    return None
+
+
+@contextmanager
+def hold_slot(options, slot):
+    """
+    Hold `slot` while the context runs, then release it even on failure.
+
+    The slot is normally acquired by a `ThrottleJob`. If it was reclaimed or
+    released by a failed attempt, it is acquired again if one is free, else
+    `SlotUnavailableError` is raised so that the job is retried rather than
+    run over the cap. The slot is refreshed every quarter of `--slot-lease`
+    so that it isn't reclaimed while in use.
+
+    Arguments:
+        options (object): toil_hla options structure.
+        slot (Slot): slot to hold, the context does nothing if None.
+    """
+    if not slot:
+        yield None
+        return
+
+    if not acquire_slot(options, slot):
+        raise exceptions.SlotUnavailableError(
+            f"The {slot.tool} slot of this job was reclaimed and all "
+            f"{slot.max_jobs} slots are taken."
+        )
+
+    path = refresh_slot(options, slot)
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(options.slot_lease * 60 / 4):
+            refresh_slot(options, slot)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+    try:
+        yield path
+    finally:
+        stop.set()
+        release_slot(options, slot)
@@ -6,6 +6,7 @@ import os
 import click
 
 from toil_hla import exceptions
+from toil_hla import utils
 
 
 def validate_patterns_are_files(patterns, check_size=True):
@@ -86,3 +87,51 @@ def validate_reference(value):
         raise click.UsageError(index + " should exist.")
 
     return value
+
+
+def validate_samples(value):
+    """
+    Make sure the passed samples file exists and has the expected header.
+
+    Rows are validated lazily with `validate_sample` as samples are claimed,
+    so that parsing time doesn't grow with the number of samples.
+    """
+    value = os.path.abspath(value)
+
+    if not os.path.isfile(value):
+        raise click.UsageError(value + " should exist.")
+
+    with open(value, "r", encoding="utf-8") as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+
+    if header[: len(utils.SAMPLES_COLUMNS)] != utils.SAMPLES_COLUMNS:
+        columns = ", ".join(utils.SAMPLES_COLUMNS)
+        raise click.UsageError(value + f" should have columns: {columns}.")
+
+    return value
+
+
+def validate_sample(sample):
+    """
+    Make sure a sample has an ID, a valid type and an indexed BAM.
+
+    Arguments:
+        sample (utils.Sample): sample to be validated.
+
+    Returns:
+        bool: True if the sample is valid.
+    """
+    if not sample.sample_id or "/" in sample.sample_id:
+        msg = f"{sample} should have a sample_id without slashes."
+        raise exceptions.ValidationError(msg)
+
+    if sample.kind not in {"DNA", "RNA"}:
+        msg = f"{sample.sample_id} type should be DNA or RNA."
+        raise exceptions.ValidationError(msg)
+
+    for i in sample.bamfile, sample.bamfile + ".bai":
+        if not sample.bamfile or not os.path.isfile(i):
+            msg = f"{sample.sample_id} {i} should exist."
+            raise exceptions.ValidationError(msg)
+
+    return True